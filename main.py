@@ -1,19 +1,125 @@
+import hashlib
+import io
+import json
+import logging
 import os
-import tempfile
+import pickle
+import re
+import subprocess
+import time
+from itertools import islice
 import click
 import requests
 import feedparser
-from datetime import datetime, timedelta
+from datetime import datetime
 from calendar import timegm
+from email.utils import mktime_tz, parsedate_tz
+from pathlib import Path
+from urllib.parse import urljoin
+from xml.etree import ElementTree
 
 import structlog
 
-from typing import Optional
-from jinja2 import Environment, PackageLoader, select_autoescape
+from typing import Iterable, Iterator, Optional
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    PackageLoader,
+    select_autoescape,
+)
 
 
 logger = structlog.get_logger(__name__)
 
+# Seconds to wait on a feed server before giving up on it.
+FETCH_TIMEOUT = 10
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Cached responses and parsed feeds not refreshed in this long are dropped.
+CACHE_MAX_AGE = 30 * SECONDS_PER_DAY
+
+CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "weeklylink"
+)
+
+
+def cache_path(kind: str, key: str, suffix: str) -> Path:
+    """Return the on-disk cache location for ``key`` under ``kind``."""
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+    return CACHE_DIR / kind / f"{digest}{suffix}"
+
+
+def prune_cache(kind: str):
+    """Remove cache entries under ``kind`` that haven't been written lately."""
+    oldest = time.time() - CACHE_MAX_AGE
+    try:
+        paths = list((CACHE_DIR / kind).iterdir())
+    except OSError:
+        return
+    for path in paths:
+        try:
+            if path.stat().st_mtime < oldest:
+                path.unlink()
+        except OSError:
+            pass
+
+
+# Only the root element is needed to tell an RSS 2.0 document from anything
+# else, and it sits near the top of the file.
+FEED_TYPE_RE = re.compile(r"<(rss|feed)\b")
+FEED_SNIFF_LENGTH = 2048
+
+XML_BASE = "{http://www.w3.org/XML/1998/namespace}base"
+XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+
+try:
+    # _sanitize_html is private to feedparser. If a release moves or renames
+    # either helper, fall back to letting feedparser.parse clean every entry.
+    from feedparser.sanitizer import _sanitize_html
+    from feedparser.urls import resolve_relative_uris
+except ImportError:
+    _sanitize_html = resolve_relative_uris = None
+
+# Most parsed entries never make it into the post, so skip feedparser's
+# per-entry HTML sanitizing and relative link rewriting while parsing. The
+# fields the template prints get both done once the items have been filtered
+# (see PostBuilder.sanitize_items).
+CLEAN_AFTER_FILTERING = _sanitize_html is not None and resolve_relative_uris is not None
+FEEDPARSER_OPTIONS = (
+    {"sanitize_html": False, "resolve_relative_uris": False}
+    if CLEAN_AFTER_FILTERING
+    else {}
+)
+
+
+def rss2_item_to_entry(
+    element: ElementTree.Element,
+) -> Optional[feedparser.FeedParserDict]:
+    """Pull the fields the template needs out of an RSS 2.0 <item>.
+
+    Values are copied as they are; like feedparser's entries they are only
+    sanitized once filtered (see PostBuilder.sanitize_items). Returns None,
+    leaving the item to feedparser, if it has no usable pubDate or lacks a
+    <link> or <description>, where feedparser falls back to the guid or
+    content:encoded.
+    """
+    pub_date = element.findtext("pubDate")
+    parsed_date = parsedate_tz(pub_date) if pub_date else None
+    link = element.findtext("link")
+    description = element.findtext("description")
+    if parsed_date is None or not link or description is None:
+        return None
+    entry = feedparser.FeedParserDict(link=link.strip(), summary=description.strip())
+    title = element.findtext("title")
+    if title is not None:
+        entry["title"] = title.strip()
+    entry["published"] = entry["updated"] = pub_date
+    entry["published_parsed"] = entry["updated_parsed"] = time.gmtime(
+        mktime_tz(parsed_date)
+    )
+    return entry
+
 
 class PostBuilder(object):
     def __init__(
@@ -39,10 +145,19 @@ class PostBuilder(object):
         self.blog_repo_branch = blog_repo_branch
         self.path_to_post = path_to_post
 
+        # Share one session (and its connection pool) across all fetches.
+        self.session = requests.Session()
+
+        # The template doesn't change during a run, so load it once and don't
+        # check it for changes; the bytecode cache lets later runs skip
+        # compiling it.
         self.jinja_env = Environment(
             loader=PackageLoader("main"),
             autoescape=select_autoescape(),
+            auto_reload=False,
+            bytecode_cache=FileSystemBytecodeCache(),
         )
+        self.template = self.jinja_env.get_template("template.md")
 
     def fetch_rss(self) -> Optional[str]:
         """Fetch RSS content from the provided URL."""
@@ -53,95 +168,342 @@ class PostBuilder(object):
 
     def fetch_rss_from_url(self, rss_url: str) -> Optional[str]:
         logger.info("Fetching RSS from URL", rss_url=rss_url)
+        # Remember the validators from the last successful fetch so an
+        # unchanged feed comes back as an empty 304 instead of a full body.
+        cache_file = cache_path("http", rss_url, ".json")
+        cached = self.read_http_cache(cache_file)
+        headers = {}
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
         try:
-            response = requests.get(rss_url)
+            response = self.session.get(rss_url, headers=headers, timeout=FETCH_TIMEOUT)
+            if response.status_code == 304 and "body" in cached:
+                logger.info("RSS feed not modified, using cached copy", rss_url=rss_url)
+                return cached["body"]
             response.raise_for_status()  # Raise an exception for bad status codes
-            return response.text
         except requests.RequestException as e:
             click.echo(f"Error fetching RSS feed: {e}", err=True)
             return None
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag or last_modified:
+            self.write_http_cache(
+                cache_file,
+                {"etag": etag, "last_modified": last_modified, "body": response.text},
+            )
+        return response.text
+
+    def read_http_cache(self, cache_file: Path) -> dict:
+        try:
+            with open(cache_file, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write_http_cache(self, cache_file: Path, entry: dict):
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(cache_file, "w") as f:
+                json.dump(entry, f)
+        except OSError as e:
+            logger.warning(
+                "Could not write HTTP cache", path=str(cache_file), error=str(e)
+            )
+        prune_cache("http")
 
     def fetch_rss_from_file(self, rss_path: str) -> Optional[str]:
         logger.info("Fetching RSS from file", rss_path=rss_path)
         with open(rss_path, "r") as f:
             return f.read()
 
-    def parse_rss(self, rss: str) -> list[dict]:
-        """Parse the RSS content into a list of dictionaries."""
-        # Read the RSS content into a list of dictionaries.
-        # Use feedparser to parse the RSS content.
-        feed = feedparser.parse(rss)
-        return feed.entries
+    def parse_rss(self, rss: str) -> Iterator[dict]:
+        """Parse the RSS content, yielding the items as they are read."""
+        # Identical RSS content parses to identical entries, so keep the parsed
+        # entries of the last run around, one cache file per feed. Parsing
+        # stops at the end of the timespan, and the consumer stops at the link
+        # limit, so those have to match as well as the content (and the
+        # feedparser version that produced the entries).
+        source = self.rss_url if self.rss_url is not None else self.rss_path
+        cache_file = cache_path("feeds", source, ".pkl")
+        digest = hashlib.blake2b(rss.encode("utf-8"), digest_size=16).hexdigest()
+        key = f"{feedparser.__version__}\n{self.timespan}\n{self.max_links}\n{digest}"
+        try:
+            with open(cache_file, "rb") as f:
+                cached = pickle.load(f)
+            if cached["key"] == key:
+                yield from cached["entries"]
+                return
+        except (
+            OSError,
+            EOFError,
+            AttributeError,
+            ImportError,
+            KeyError,
+            TypeError,
+            pickle.PickleError,
+        ):
+            # Missing, truncated, or written by an incompatible version.
+            pass
+
+        # Only cache a complete result: either every item was parsed, or there
+        # are max_links of them, which is all the consumer (or a rerun) will
+        # take. A consumer that fails partway leaves nothing behind.
+        entries = []
+        for entry in self.parse_rss_entries(rss):
+            entries.append(entry)
+            if self.max_links is not None and len(entries) >= self.max_links:
+                self.write_feed_cache(cache_file, key, entries)
+                yield entry
+                return
+            yield entry
+        self.write_feed_cache(cache_file, key, entries)
+
+    def write_feed_cache(self, cache_file: Path, key: str, entries: list[dict]):
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(cache_file, "wb") as f:
+                pickle.dump(
+                    {"key": key, "entries": entries},
+                    f,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+        except OSError as e:
+            logger.warning(
+                "Could not write feed cache", path=str(cache_file), error=str(e)
+            )
+        prune_cache("feeds")
+
+    def parse_rss_entries(self, rss: str) -> Iterator[dict]:
+        """Parse the items in the RSS content that fall within the timespan."""
+        cutoff = self.timespan_cutoff()
+        if cutoff is None:
+            # Every item is wanted, and one full parse is quicker than going
+            # item by item.
+            yield from feedparser.parse(rss, **FEEDPARSER_OPTIONS).entries
+            return
 
-    def filter_items(self, items: list[dict]) -> list[dict]:
+        # Feeds list their newest items first, so rather than handing the whole
+        # document to feedparser, walk the <item> (or Atom <entry>) elements in
+        # order, parse each one on its own and stop at the first item that is
+        # older than the timespan. Items are yielded as soon as they are
+        # parsed, so a consumer that stops early (at max_links) also stops the
+        # parsing. Plain RSS 2.0 items only need a few child elements read, so
+        # those skip feedparser altogether.
+        match = FEED_TYPE_RE.search(rss, 0, FEED_SNIFF_LENGTH)
+        # Entries built without feedparser can only be cleaned after filtering.
+        is_rss2 = (
+            CLEAN_AFTER_FILTERING and match is not None and match.group(1) == "rss"
+        )
+        # An item parsed on its own loses any xml:base / xml:lang set on its
+        # ancestors, so track the inherited values and copy them onto it.
+        inherited = [(None, None)]
+        # Items handled so far, whether or not they produced an entry.
+        processed = 0
+        try:
+            for event, element in ElementTree.iterparse(
+                io.StringIO(rss), events=("start", "end")
+            ):
+                if event == "start":
+                    base, lang = inherited[-1]
+                    if XML_BASE in element.attrib:
+                        base = urljoin(base or "", element.get(XML_BASE))
+                    inherited.append((base, element.get(XML_LANG, lang)))
+                    continue
+                base, lang = inherited.pop()
+                if element.tag.rpartition("}")[2] not in ("item", "entry"):
+                    continue
+                processed += 1
+                entry = None
+                if is_rss2 and base is None:
+                    entry = rss2_item_to_entry(element)
+                if entry is None:
+                    if base is not None:
+                        element.set(XML_BASE, base)
+                    if lang is not None:
+                        element.set(XML_LANG, lang)
+                    parsed = feedparser.parse(
+                        ElementTree.tostring(element), **FEEDPARSER_OPTIONS
+                    )
+                    entry = parsed.entries[0] if parsed.entries else None
+                element.clear()
+                if entry is None:
+                    continue
+                updated = entry.get("updated_parsed")
+                if updated and timegm(updated) < cutoff:
+                    return
+                yield entry
+        except ElementTree.ParseError:
+            # feedparser copes with malformed feeds that ElementTree rejects.
+            # Carry on from after the items that were already handled.
+            entries = feedparser.parse(rss, **FEEDPARSER_OPTIONS).entries
+            yield from islice(entries, processed, None)
+
+    def timespan_cutoff(self) -> Optional[int]:
+        """Return the UTC timestamp of the oldest item within the timespan."""
+        if not (isinstance(self.timespan, str) and self.timespan.isdigit()):
+            return None
+        # Item dates are UTC epoch seconds, so work in those too; no local
+        # time (or DST) is involved. A timespan of 0 still covers the last
+        # day rather than nothing at all.
+        days = max(int(self.timespan), 1)
+        return int(time.time()) - days * SECONDS_PER_DAY
+
+    def filter_items(self, items: Iterable[dict]) -> list[dict]:
         """Filter the items based on the timespan."""
         # Filter the items based on the timespan.
         # If the timespan is a number (it will always be a string, but
         # check to see if it's numeric), filter the items based on the number of days.
         # If the timespan is a date, filter the items based on the date.
+        # If there is no timespan (or it is "all"), there is nothing to filter
+        # by date, so only the link limit applies.
 
-        if isinstance(self.timespan, str) and self.timespan.isdigit():
-            return self.filter_items_by_days(items)
+        if not self.timespan or self.timespan == "all":
+            matching_items = list(islice(items, self.max_links))
+        elif isinstance(self.timespan, str) and self.timespan.isdigit():
+            matching_items = self.filter_items_by_days(items)
         else:
             raise NotImplementedError("Filtering by date not implemented")
+        return self.sanitize_items(matching_items)
 
-    def filter_items_by_days(self, items: list[dict]) -> list[dict]:
+    def filter_items_by_days(self, items: Iterable[dict]) -> list[dict]:
         """Filter the items based on the number of days."""
-        matching_items = []
+        # Compare raw epoch seconds against a cutoff worked out once, rather
+        # than building datetimes for every item. Items are newest first, so
+        # stop pulling them (and so parsing them) once there are max_links
+        # matches.
+        cutoff = self.timespan_cutoff()
+        matching_items = (
+            item for item in items if timegm(item.updated_parsed) >= cutoff
+        )
+        return list(islice(matching_items, self.max_links))
+
+    def sanitize_items(self, items: list[dict]) -> list[dict]:
+        """Clean up the HTML in the fields the template copies into the post."""
+        # The post lives on another site, so resolve relative links against
+        # the entry's xml:base. The template isn't autoescaped either, so strip
+        # scripts and the like from anything it prints. Both are the steps
+        # feedparser would have taken while parsing. Items are copied so the
+        # parsed (and cached) entries are left untouched.
+        if not CLEAN_AFTER_FILTERING:
+            # feedparser already cleaned them while parsing.
+            return list(items)
+        sanitized_items = []
         for item in items:
-            item_date = datetime.fromtimestamp(timegm(item.updated_parsed))
-            days_ago = (datetime.now() - item_date).days
-            logger.debug("Item date", item_date=item_date, days_ago=days_ago)
-            if days_ago > int(self.timespan):
-                continue
-            matching_items.append(item)
-        return matching_items
-
-    def assemble_post(self, items: list[dict]) -> str:
+            item = feedparser.FeedParserDict(item)
+            for field in ("title", "summary"):
+                if not item.get(field):
+                    continue
+                value = item[field]
+                base = item.get(f"{field}_detail", {}).get("base")
+                if base:
+                    value = resolve_relative_uris(value, base, "utf-8", "text/html")
+                item[field] = _sanitize_html(value, "utf-8", "text/html")
+            sanitized_items.append(item)
+        return sanitized_items
+
+    def assemble_post(self, items: list[dict], date: datetime) -> str:
         """Assemble the post from the items."""
         # Assemble the post from the items.
         # Use the Jinja template to assemble the post.
-        template = self.jinja_env.get_template("template.md")
-        post = template.render(items=items, date=datetime.now())
+        post = self.template.render(items=items, date=date)
         return post
 
-    def push_post_to_blog_repo(self, post: str):
-        """Push the post to the blog repo."""
-        # Checkout the blog repo locally into a temporary directory.
+    def run_git(self, *args: str, repo_dir: Optional[Path] = None):
+        """Run a git command directly, without going through a shell."""
+        command = ["git", *args] if repo_dir is None else ["git", "-C", repo_dir, *args]
+        try:
+            subprocess.run(command, check=True, capture_output=True, text=True)
+        except subprocess.CalledProcessError as e:
+            # The command line can include the repo URL (and any token in it),
+            # so report git's own error output rather than the command.
+            output = (e.stderr or e.stdout).strip()
+            raise RuntimeError(f"git failed: {output}") from e
+
+    def checkout_blog_repo(self) -> Path:
+        """Bring a local checkout of the blog repo up to date and return it."""
+        # The checkout is kept between runs, so after the first clone only new
+        # commits need to be fetched. Only the tip of the target branch is
+        # needed to add a post. The directory is named after a hash of the
+        # repo URL so any token in it stays out of the path.
+        repo_dir = cache_path("repos", f"{self.blog_repo}\n{self.blog_repo_branch}", "")
+        if (repo_dir / ".git").exists():
+            logger.debug("Updating blog repo", repo_dir=str(repo_dir))
+            self.run_git(
+                "fetch", "--depth=1", "origin", self.blog_repo_branch, repo_dir=repo_dir
+            )
+            # Throw away anything left over from an earlier run that failed.
+            self.run_git("reset", "--hard", "FETCH_HEAD", repo_dir=repo_dir)
+            self.run_git("clean", "-fdx", repo_dir=repo_dir)
+        else:
+            logger.debug("Cloning blog repo", repo_dir=str(repo_dir))
+            repo_dir.parent.mkdir(parents=True, exist_ok=True)
+            self.run_git(
+                "clone",
+                "--depth=1",
+                "--single-branch",
+                f"--branch={self.blog_repo_branch}",
+                self.blog_repo,
+                str(repo_dir),
+            )
+        return repo_dir
+
+    def push_post_to_blog_repo(
+        self, items: list[dict], date: datetime, post: Optional[str] = None
+    ):
+        """Push the post to the blog repo.
+
+        If the post has already been assembled (e.g. for a preview), that exact
+        text is written; otherwise it is rendered from the items.
+        """
+        # Checkout the blog repo locally.
 
         # We create a slug for this post, e.g., "assorted-links-2025-02-11"
 
-        slug = f"assorted-links-{datetime.now().strftime('%Y-%m-%d')}"
+        slug = f"assorted-links-{date.strftime('%Y-%m-%d')}"
 
         content_directory = ""
-        tmp_dir = tempfile.mkdtemp()
-        logger.debug("Cloning blog repo", repo=self.blog_repo, tmp_dir=tmp_dir)
-        os.system(f"git clone {self.blog_repo} {tmp_dir}")
-        os.mkdir(os.path.join(tmp_dir, self.path_to_post, slug))
+        repo_dir = self.checkout_blog_repo()
+        # Work out where the post goes once and use it for every step.
+        post_path = Path(repo_dir, self.path_to_post, slug, "index.md")
+        post_path.parent.mkdir(parents=True, exist_ok=True)
         # Add the file to the repo in the correct place.
-        logger.debug(
-            "Writing post to repo",
-            post=post,
-            path=os.path.join(tmp_dir, self.path_to_post, slug, "index.md"),
-        )
-        with open(os.path.join(tmp_dir, self.path_to_post, slug, "index.md"), "w") as f:
-            f.write(post)
+        logger.debug("Writing post to repo", path=str(post_path))
+        if post is not None:
+            post_path.write_text(post, encoding="utf-8")
+        else:
+            # Render the template straight into the file rather than building
+            # the whole post as a string first.
+            self.template.stream(items=items, date=date).dump(
+                str(post_path), encoding="utf-8"
+            )
         # Commit the file.
-        # Temporarily disable signed commits.
-        os.system(f"git -C {tmp_dir} config --local commit.gpgsign false")
-        os.system(
-            f"git -C {tmp_dir} add {os.path.join(tmp_dir, self.path_to_post, slug, 'index.md')}"
+        self.run_git("add", str(post_path), repo_dir=repo_dir)
+        # Disable signed commits for this one command only; no need to spend a
+        # separate git process writing it into the clone's config.
+        self.run_git(
+            "-c",
+            "commit.gpgsign=false",
+            "commit",
+            "-m",
+            "Add new assorted links.",
+            repo_dir=repo_dir,
         )
-        os.system(f"git -C {tmp_dir} commit -m 'Add new assorted links.'")
         # Push the file to the repo.
-        os.system(f"git -C {tmp_dir} push")
+        self.run_git("push", repo_dir=repo_dir)
 
 
 @click.command()
 @click.option("--rss-url", help="URL of the RSS feed")
 @click.option("--rss-path", help="Path to local RSS file")
 @click.option("--max-links", type=int, help="Maximum number of links to include")
-@click.option("--timespan", default="7", help="Timespan in days for filtering posts")
+@click.option(
+    "--timespan",
+    default="7",
+    help='Timespan in days for filtering posts (0 means the last day), or "all"'
+    " for no limit",
+)
 @click.option(
     "--blog-repo", required=True, help="Git repository URL (with token if needed)"
 )
@@ -150,6 +512,7 @@ class PostBuilder(object):
     "--path-to-post", default="content/post", help="Path where posts should be saved"
 )
 @click.option("--no-interactive", is_flag=True, help="Skip confirmation before posting")
+@click.option("--verbose", is_flag=True, help="Show debug logging")
 def main(
     rss_url,
     rss_path,
@@ -159,8 +522,16 @@ def main(
     blog_repo_branch,
     path_to_post,
     no_interactive,
+    verbose,
 ):
     """Generate and publish blog posts from RSS feeds."""
+    # Below the configured level, log calls return immediately instead of
+    # building an event dict and running it through the processors.
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(
+            logging.DEBUG if verbose else logging.INFO
+        )
+    )
     try:
         builder = PostBuilder(
             rss_url=rss_url,
@@ -177,16 +548,21 @@ def main(
             logger.error("Failed to fetch RSS content")
             return
 
-        items = builder.parse_rss(rss)
-        items = builder.filter_items(items)
+        # Items are parsed lazily as filter_items pulls them, so parsing and
+        # filtering happen in a single pass.
+        items = builder.filter_items(builder.parse_rss(rss))
+        logger.debug("Filtered items", count=len(items))
 
         if len(items) == 0:
             logger.info("Nothing to post.")
             return
 
-        post = builder.assemble_post(items)
-
+        # Take the date once so the preview, the slug and the published post
+        # all agree, even across midnight.
+        date = datetime.now()
+        post = None
         if not no_interactive:
+            post = builder.assemble_post(items, date)
             click.echo("\nGenerated post content:")
             click.echo("-" * 40)
             click.echo(post)
@@ -195,7 +571,7 @@ def main(
                 click.echo("Aborted.")
                 return
 
-        builder.push_post_to_blog_repo(post)
+        builder.push_post_to_blog_repo(items, date, post=post)
         logger.info("Successfully published new post")
 
     except Exception as e: